@@ -1,14 +1,16 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import datetime
+import hashlib
 import time
-import plotly.graph_objects as go
 import threading
 import os
+import tempfile
 import logging
-import json
+import orjson
 from collections import deque
 import atexit
-import pytz
+import contextlib
+from zoneinfo import ZoneInfo
 
 app = Flask(__name__)
 
@@ -21,14 +23,71 @@ logging.basicConfig(
     ]
 )
 
-graph_data = {'x': [], 'y': []}
-graph_lock = threading.Lock()
+class RWLock:
+    """
+    Lock that admits any number of concurrent readers or a single writer.
+    Waiting writers block new readers so a stream of status polls cannot
+    starve a POST.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            except BaseException:
+                # Give up the place in line and wake readers held back by it
+                self._writers_waiting -= 1
+                self._cond.notify_all()
+                raise
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+# x_dt holds parsed 5-minute marks, parallel to the x_iso strings that are persisted
+graph_data = {'x_iso': [], 'x_dt': [], 'y': bytearray()}
+graph_lock = RWLock()
+# Serializes save_data so snapshots reach the disk in the order they were taken
+save_lock = threading.Lock()
 recent_posts = deque(maxlen=50)
 last_update_time = None
 update_thread = None
+graph_thread = None
+graph_dirty = threading.Event()
 shutdown_flag = threading.Event()
+graph_html_cache = {'mtime': 0, 'bytes': b'', 'etag': ''}
+# (iso, utc datetime, local datetime, status) of the latest data point
+last_snapshot = (None, None, None, 0)
 
-timezone = pytz.timezone('Europe/Helsinki')
+timezone = ZoneInfo('Europe/Helsinki')
+# Shorter than the time between any two DST transitions in Europe/Helsinki
+DST_FREE_SPAN = datetime.timedelta(days=100)
 
 CONFIG = {
     'graph_file': 'power_graph.html',
@@ -37,65 +96,192 @@ CONFIG = {
     'update_interval': 5,
     'extra_wait': 240,
     'grace_period_sec': 60,  # 1-minute grace period
+    'graph_debounce_sec': 0.5,
+    'compress_runs_above': 1000,  # collapse flat runs and drop markers past this many points
+    'max_points': 8640,  # 30 days of 5-minute marks
     'server_port': int(os.getenv('PORT', 10000))
 }
 
+def localize_series(dts):
+    """
+    Convert sorted UTC datetimes to naive Europe/Helsinki wall times. The UTC
+    offset is looked up once per stretch of points without a DST transition,
+    bisecting only the stretches that cross one
+    """
+    local = []
+    stack = [(0, len(dts))] if dts else []
+    while stack:
+        lo, hi = stack.pop()
+        offset = dts[lo].astimezone(timezone).utcoffset()
+        same_offset = (
+            dts[hi - 1] - dts[lo] < DST_FREE_SPAN
+            and dts[hi - 1].astimezone(timezone).utcoffset() == offset
+        )
+        if hi - lo == 1 or same_offset:
+            local.extend(dt.replace(tzinfo=None) + offset for dt in dts[lo:hi])
+        else:
+            mid = (lo + hi) // 2
+            stack.append((mid, hi))
+            stack.append((lo, mid))
+    return local
+
 def round_to_5min(dt):
-    minute = dt.minute
-    rounded = minute - (minute % 5) if minute % 5 < 2.5 else minute + (5 - minute % 5)
-    if rounded == 60:
-        dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
-    else:
-        dt = dt.replace(minute=rounded)
-    return dt.replace(second=0, microsecond=0)
+    # Round on whole epoch minutes: minutes 0-2 of a slot round down, 3-4 up
+    minutes = int(dt.timestamp() // 60)
+    rounded = (minutes + 2) // 5 * 5
+    return datetime.datetime.fromtimestamp(rounded * 60, tz=dt.tzinfo)
+
+# os.umask can only be read by setting it, do it once at import
+UMASK = os.umask(0)
+os.umask(UMASK)
 
-def backfill_missing_data(current_time):
+def write_atomic(path, data):
     """
-    Backfill missing data points with zeros when server wakes up from sleep
+    Write bytes to a temporary file and move it over the target so readers
+    never see a partially written file
     """
-    with graph_lock:
-        if not graph_data['x']:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb', buffering=1 << 20) as f:
+            # mkstemp creates the file 0600, give it the permissions open() would
+            os.fchmod(f.fileno(), 0o666 & ~UMASK)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+# Graph page drawn client-side by plotly.js, updates only substitute the data arrays
+GRAPH_TEMPLATE = b"""<html>
+<head>
+    <meta charset="utf-8" />
+    <title>Outlet Power Status</title>
+    <script src="https://cdn.plot.ly/plotly-2.35.2.min.js"></script>
+</head>
+<body>
+    <div id="graph"></div>
+    <script>
+        Plotly.newPlot('graph', [{
+            x: {{X_JSON}},
+            y: {{Y_JSON}},
+            type: 'scatter',
+            mode: {{MODE_JSON}}
+        }], {
+            title: {text: 'Outlet Power Status'},
+            xaxis: {title: {text: 'Time (Europe/Helsinki)'}, gridcolor: '#EBF0F8', zerolinecolor: '#EBF0F8'},
+            yaxis: {title: {text: 'Power (0 or 1)'}, gridcolor: '#EBF0F8', zerolinecolor: '#EBF0F8'},
+            plot_bgcolor: 'white'
+        }, {responsive: true});
+    </script>
+</body>
+</html>
+"""
+
+def compress_runs(x, y):
+    """
+    Drop the interior points of runs of equal values, keeping the first and
+    last point of each run so the plotted line keeps the same shape
+    """
+    if len(y) < 3:
+        return x, y
+    keep = [0]
+    for i in range(1, len(y) - 1):
+        if y[i] != y[i - 1] or y[i] != y[i + 1]:
+            keep.append(i)
+    keep.append(len(y) - 1)
+    return [x[i] for i in keep], [y[i] for i in keep]
+
+def trim_history():
+    """
+    Drop the oldest data points beyond CONFIG['max_points'], call with graph_lock held for writing
+    """
+    excess = len(graph_data['x_iso']) - CONFIG['max_points']
+    if excess > 0:
+        del graph_data['x_iso'][:excess]
+        del graph_data['x_dt'][:excess]
+        del graph_data['y'][:excess]
+
+def update_last_snapshot():
+    """
+    Cache the latest data point for /status_text, call with graph_lock held for writing
+    """
+    global last_snapshot
+    latest_dt_utc = graph_data['x_dt'][-1].replace(tzinfo=datetime.timezone.utc)
+    last_snapshot = (graph_data['x_iso'][-1], latest_dt_utc, latest_dt_utc.astimezone(timezone), graph_data['y'][-1])
+
+def backfill_missing_data(current_mark):
+    """
+    Backfill missing data points with zeros when server wakes up from sleep,
+    current_mark is the already rounded 5-min mark of the incoming POST
+    """
+    with graph_lock.write():
+        if not graph_data['x_dt']:
             # No previous data, nothing to backfill
             return False
         
-        # Get the last recorded timestamp and convert to datetime
-        last_timestamp = datetime.datetime.fromisoformat(graph_data['x'][-1])
-        current_mark = round_to_5min(current_time)
-        last_mark = round_to_5min(last_timestamp)
+        # The last recorded timestamp is already a 5-min mark
+        last_mark = graph_data['x_dt'][-1]
         
         # Check if there's a gap (more than one 5-min interval) between last record and now
         if (current_mark - last_mark).total_seconds() > 5 * 60:
             logging.info(f"Detected gap from {last_mark} to {current_mark}. Backfilling...")
             
-            # Start from the next 5-min mark after the last recorded timestamp
-            backfill_time = last_mark + datetime.timedelta(minutes=5)
+            # Every 5-min mark after the last recorded one, up to the current mark (exclusive)
+            # Marks older than the history cap would be trimmed right away
+            missing = int((current_mark - last_mark).total_seconds() // (5 * 60)) - 1
+            first = max(1, missing - CONFIG['max_points'] + 1)
+            marks = [last_mark + datetime.timedelta(minutes=5 * i) for i in range(first, missing + 1)]
             
-            # Continue until we reach the current 5-min mark (exclusive)
-            while backfill_time < current_mark:
-                # Add a data point with value 0 for each missing 5-min interval
-                graph_data['x'].append(backfill_time.isoformat())
-                graph_data['y'].append(0)
-                logging.info(f"Backfilled data point at {backfill_time} with value 0")
-                backfill_time += datetime.timedelta(minutes=5)
+            # Add a data point with value 0 for each missing 5-min interval
+            graph_data['x_iso'].extend(mark.isoformat() for mark in marks)
+            graph_data['x_dt'].extend(marks)
+            graph_data['y'].extend(bytes(len(marks)))
+            trim_history()
+            logging.info(f"Backfilled {len(marks)} data points from {marks[0]} to {marks[-1]} with value 0")
             
             return True
     
     return False
 
+def render_graph(x, y, compress_runs_above):
+    """
+    Render the graph page for a snapshot of UTC marks and power values.
+    Only depends on its arguments and module constants.
+    """
+    mode = b'"lines+markers"'
+    if len(x) > compress_runs_above:
+        # Markers would only remain at run ends, so draw the collapsed series as a plain line
+        x, y = compress_runs(x, y)
+        mode = b'"lines"'
+    x = localize_series(x)
+    return (
+        GRAPH_TEMPLATE.replace(b'{{X_JSON}}', orjson.dumps(x))
+        .replace(b'{{Y_JSON}}', orjson.dumps(list(y)))
+        .replace(b'{{MODE_JSON}}', mode)
+    )
+
+def cache_graph_html(html, mtime):
+    """
+    Swap in the served copy of the graph page in one assignment so readers
+    never see bytes and validators from different renders
+    """
+    global graph_html_cache
+    graph_html_cache = {'mtime': mtime, 'bytes': html, 'etag': hashlib.blake2b(html, digest_size=16).hexdigest()}
+
 def update_graph():
     global last_update_time
     try:
-        with graph_lock:
-            x = [datetime.datetime.fromisoformat(ts).astimezone(timezone) for ts in graph_data['x']]
-            y = graph_data['y'][:]
-        fig = go.Figure(data=go.Scatter(x=x, y=y, mode='lines+markers'))
-        fig.update_layout(
-            title='Outlet Power Status',
-            xaxis_title='Time (Europe/Helsinki)',
-            yaxis_title='Power (0 or 1)',
-            template='plotly_white'
-        )
-        fig.write_html(CONFIG['graph_file'])
+        with graph_lock.read():
+            x = graph_data['x_dt'][:]
+            y = bytes(graph_data['y'])
+        html = render_graph(x, y, CONFIG['compress_runs_above'])
+        write_atomic(CONFIG['graph_file'], html)
+        cache_graph_html(html, os.path.getmtime(CONFIG['graph_file']))
         last_update_time = datetime.datetime.now()
         save_data()
     except Exception as e:
@@ -103,72 +289,126 @@ def update_graph():
 
 def save_data():
     try:
-        with graph_lock:
-            with open(CONFIG['data_file'], 'w') as f:
-                json.dump(graph_data, f)
+        with save_lock:
+            with graph_lock.read():
+                data = orjson.dumps({'x': graph_data['x_iso'], 'y': list(graph_data['y'])})
+            write_atomic(CONFIG['data_file'], data)
     except Exception as e:
         logging.error(f'Data save error: {e}')
 
 def load_data():
     try:
         if os.path.exists(CONFIG['data_file']):
-            with open(CONFIG['data_file'], 'r') as f:
-                data = json.load(f)
+            with open(CONFIG['data_file'], 'rb') as f:
+                data = orjson.loads(f.read())
             if 'x' in data and 'y' in data:
-                with graph_lock:
-                    graph_data['x'] = data['x']
-                    graph_data['y'] = data['y']
+                # Parse all timestamps once at startup, the hot paths never parse again
+                xs = data['x']
+                ys = bytearray(data['y'])
+                dts = list(map(datetime.datetime.fromisoformat, xs))
+                with graph_lock.write():
+                    graph_data['x_iso'] = xs
+                    graph_data['x_dt'] = dts
+                    graph_data['y'] = ys
+                    trim_history()
+                    if graph_data['x_dt']:
+                        update_last_snapshot()
     except Exception as e:
         logging.error(f'Data load error: {e}')
 
-def get_time_to_next_mark():
-    now = datetime.datetime.now(datetime.timezone.utc)
+def load_graph_html():
+    """
+    Serve the graph page left by a previous run until the first update
+    """
+    try:
+        with open(CONFIG['graph_file'], 'rb') as f:
+            cache_graph_html(f.read(), os.fstat(f.fileno()).st_mtime)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.error(f'Graph load error: {e}')
+
+def get_time_to_next_mark(now):
     next_mark = round_to_5min(now + datetime.timedelta(minutes=5))
     return (next_mark - now).total_seconds(), next_mark
 
-def check_and_update_status():
-    now = datetime.datetime.now(datetime.timezone.utc)
+def check_and_update_status(now):
+    global last_snapshot
     current_mark = round_to_5min(now)
-    with graph_lock:
-        if not graph_data['x'] or round_to_5min(datetime.datetime.fromisoformat(graph_data['x'][-1])) < current_mark:
-            graph_data['x'].append(current_mark.isoformat())
+    current_iso = current_mark.isoformat()
+    snapshot = (current_iso, current_mark, current_mark.astimezone(timezone), 0)
+    with graph_lock.write():
+        if not graph_data['x_dt'] or graph_data['x_dt'][-1] < current_mark:
+            graph_data['x_iso'].append(current_iso)
+            graph_data['x_dt'].append(current_mark)
             graph_data['y'].append(0)
-            threading.Thread(target=update_graph, daemon=True).start()
+            trim_history()
+            last_snapshot = snapshot
+            graph_dirty.set()
 
 def background_task():
     while not shutdown_flag.is_set():
-        sleep_time, _ = get_time_to_next_mark()
+        sleep_time, _ = get_time_to_next_mark(datetime.datetime.now(datetime.timezone.utc))
         time.sleep(sleep_time + CONFIG['extra_wait'])
-        check_and_update_status()
+        check_and_update_status(datetime.datetime.now(datetime.timezone.utc))
+
+def graph_task():
+    # Coalesce bursts of updates into a single graph rebuild
+    while not shutdown_flag.is_set():
+        graph_dirty.wait()
+        graph_dirty.clear()
+        time.sleep(CONFIG['graph_debounce_sec'])
+        if not shutdown_flag.is_set():
+            update_graph()
 
 def start_background_thread():
-    global update_thread
+    global update_thread, graph_thread
     if not update_thread or not update_thread.is_alive():
         update_thread = threading.Thread(target=background_task, daemon=True)
         update_thread.start()
+    if not graph_thread or not graph_thread.is_alive():
+        graph_thread = threading.Thread(target=graph_task, daemon=True)
+        graph_thread.start()
 
 def stop_background_thread():
     shutdown_flag.set()
+    graph_dirty.set()
 
 @app.route('/power_status', methods=['POST'])
 def power_status():
+    global last_snapshot
     try:
+        # Read the clock and round it once for both the backfill and the current POST
         received_at = datetime.datetime.now(datetime.timezone.utc)
+        rounded_dt = round_to_5min(received_at)
         
         # First, check if we need to backfill missing data
-        backfilled = backfill_missing_data(received_at)
+        backfilled = backfill_missing_data(rounded_dt)
         
-        # Now handle the current POST
-        rounded = round_to_5min(received_at).isoformat()
-        with graph_lock:
-            if graph_data['x'] and round_to_5min(datetime.datetime.fromisoformat(graph_data['x'][-1])).isoformat() == rounded:
-                graph_data['y'][-1] = 1
+        # Now handle the current POST, building the new point and the status
+        # snapshot before taking the lock
+        rounded_iso = rounded_dt.isoformat()
+        snapshot = (rounded_iso, rounded_dt, rounded_dt.astimezone(timezone), 1)
+        changed = backfilled
+        with graph_lock.write():
+            if graph_data['x_iso'] and graph_data['x_iso'][-1] == rounded_iso:
+                if graph_data['y'][-1] != 1:
+                    graph_data['y'][-1] = 1
+                    changed = True
             else:
-                graph_data['x'].append(rounded)
+                graph_data['x_iso'].append(rounded_iso)
+                graph_data['x_dt'].append(rounded_dt)
                 graph_data['y'].append(1)
+                trim_history()
+                changed = True
+            # After a POST the newest point is always this one
+            if changed:
+                last_snapshot = snapshot
         
-        # Update the graph with both backfilled data and current POST
-        threading.Thread(target=update_graph, daemon=True).start()
+        # Update the graph with both backfilled data and current POST,
+        # repeated POSTs within the same 5-minute slot leave it as is
+        if changed:
+            graph_dirty.set()
         
         return jsonify({'status': 'success', 'backfilled': backfilled})
     except Exception as e:
@@ -181,13 +421,21 @@ def index():
 
 @app.route('/power_graph')
 def power_graph():
-    return open(CONFIG['graph_file']).read() if os.path.exists(CONFIG['graph_file']) else 'Graph not ready.'
+    # Only this process writes the graph file, so the cached copy is always current
+    cache = graph_html_cache
+    if not cache['bytes']:
+        return 'Graph not ready.', 503
+    # Clients that already have this render (meta refresh, reloads) get a 304
+    response = Response(cache['bytes'], mimetype='text/html')
+    response.set_etag(cache['etag'])
+    response.last_modified = cache['mtime']
+    return response.make_conditional(request)
 
 @app.route('/status')
 def status():
-    with graph_lock:
-        data_points = len(graph_data['x'])
-        latest = graph_data['x'][-1] if data_points else 'none'
+    with graph_lock.read():
+        data_points = len(graph_data['x_iso'])
+        latest = graph_data['x_iso'][-1] if data_points else 'none'
     return jsonify({
         'points': data_points,
         'latest': latest,
@@ -197,26 +445,16 @@ def status():
 @app.route('/status_text')
 def status_text():
     try:
-        with graph_lock:
-            if not graph_data['x']:
-                return '<p>Status unknown</p>'
-            latest_dt_utc = datetime.datetime.fromisoformat(graph_data['x'][-1]).replace(tzinfo=datetime.timezone.utc)
-            latest_local = latest_dt_utc.astimezone(timezone)
-            latest_status = graph_data['y'][-1]
+        # A single tuple read, no lock needed
+        latest_iso, latest_dt_utc, latest_local, latest_status = last_snapshot
+        if latest_iso is None:
+            return '<p>Status unknown</p>'
 
         now_utc = datetime.datetime.now(datetime.timezone.utc)
         
-        # Calculate the time of the next expected POST (next 5-minute mark after the latest data point)
-        latest_dt_rounded = round_to_5min(latest_dt_utc)
-        next_expected_post = latest_dt_rounded
-        
-        # If the latest data point is already at a 5-minute mark and has a status of 1
-        # then the next expected post is 5 minutes later
-        if latest_dt_rounded == latest_dt_utc and latest_status == 1:
-            next_expected_post = latest_dt_rounded + datetime.timedelta(minutes=5)
-        # If it's not at a 5-minute mark or status is 0, the next expected post is the next 5-minute mark
-        elif latest_dt_rounded <= latest_dt_utc:
-            next_expected_post = latest_dt_rounded + datetime.timedelta(minutes=5)
+        # The latest data point is always a 5-minute mark, so the next expected POST
+        # is the following mark
+        next_expected_post = latest_dt_utc + datetime.timedelta(minutes=5)
             
         # Add the grace period
         grace_period_end = next_expected_post + datetime.timedelta(seconds=CONFIG['grace_period_sec'])
@@ -249,7 +487,15 @@ def cleanup():
 
 atexit.register(cleanup)
 
-if __name__ == '__main__':
+def create_app():
+    """
+    Load the saved history and start the background threads, used as the
+    gunicorn entry point
+    """
     load_data()
+    load_graph_html()
     start_background_thread()
-    app.run(host='0.0.0.0', port=CONFIG['server_port'], threaded=True)
+    return app
+
+if __name__ == '__main__':
+    create_app().run(host='0.0.0.0', port=CONFIG['server_port'], threaded=True)